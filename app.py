@@ -1,11 +1,28 @@
+import functools
 import os
-import threading
-from flask import Flask, request, redirect, url_for, render_template_string, session
+import re
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, g, request, redirect, url_for, send_from_directory
 from dotenv import load_dotenv
 
-from stream import run_ffmpeg, validate_paths
+from library import LibraryIndex
+from stream import (
+    run_ffmpeg, stop_ffmpeg, validate_paths, needs_transcode, make_stream_folder,
+    cleanup_stale_stream_folders, is_dir_fast, is_file_fast,
+)
 import shutil
 import socket
+import struct
+import sys
+import threading
+import time
+import warnings
+
+try:
+    import fcntl  # Not available on Windows
+except ImportError:
+    fcntl = None
 
 try:
     import psutil  # Optional; used for VPN detection
@@ -17,22 +34,94 @@ load_dotenv()
 
 # Base directory with video files
 MOVIES_DIR = os.getenv("MOVIES_DIR", os.path.expanduser("~/Movies"))
+# Normalized once; every path handed out by secure_path() starts with it
+_MOVIES_ROOT = os.path.join(os.path.abspath(MOVIES_DIR), '')
 
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY", "change_this_secret")
+# Templates are compiled in code, so never stat() them for changes
+app.config['TEMPLATES_AUTO_RELOAD'] = False
+app.jinja_env.auto_reload = False
 # supported file extensions
 VIDEO_EXTS = {'.mp4', '.mkv', '.avi', '.mov', '.flv', '.wmv', '.webm', '.ts'}
 SUB_EXTS = {'.srt', '.vtt', '.ass', '.ssa'}
+# extension (without dot) -> entry type, matched with one precompiled regex
+_EXT_KIND = {**{e[1:]: 'video' for e in VIDEO_EXTS}, **{e[1:]: 'subtitle' for e in SUB_EXTS}}
+_EXT_RE = re.compile(r'\.(' + '|'.join(sorted(_EXT_KIND)) + r')\Z', re.IGNORECASE)
+
+# SQLite index of MOVIES_DIR, kept in sync by a watchdog observer
+LIBRARY_DB = os.getenv("LIBRARY_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'library.db'))
+LIBRARY = LibraryIndex(MOVIES_DIR, LIBRARY_DB)
+if not LIBRARY.start():
+    print("Warning: library index disabled (watchdog not installed or MOVIES_DIR missing)")
+
+# Background pool used to hydrate OneDrive files without blocking requests
+PREFETCH_POOL = ThreadPoolExecutor(max_workers=2)
+# Content types of the files produced by ffmpeg's HLS muxer
+HLS_MIMETYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.m4s': 'video/iso.segment',
+    '.mp4': 'video/mp4',
+    '.ts': 'video/mp2t',
+    '.vtt': 'text/vtt',
+}
+
+# Server-side session state keyed by the "sid" cookie, so requests only
+# carry a short random id instead of the signed selection paths. A session
+# also owns its stream: 'stream_folder', 'stream_job' (its FFMPEG_POOL
+# future) and 'stream_token'. 'last_seen' is the monotonic time of the
+# session's last request or /hls hit.
+SESSIONS: dict[str, dict] = {}
+# Sessions by stream token. The stream URL (/hls/<token>/) is shown on the
+# page and given to players, so it carries its own random token rather than
+# the sid, which would let anyone who sees the URL take over the session.
+STREAMS: dict[str, dict] = {}
+# Seconds without any request or /hls hit after which a session and its
+# stream are dropped (0 keeps sessions forever)
+SESSION_IDLE_TIMEOUT = int(os.getenv("SESSION_IDLE_TIMEOUT", "14400"))
+
+# Remove output left behind by earlier runs that were killed
+cleanup_stale_stream_folders()
 
+# Bounded pool running ffmpeg jobs; extra streams queue until a slot frees up
+FFMPEG_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("FFMPEG_JOBS", os.cpu_count() or 1)))
+
+@functools.lru_cache(maxsize=4096)
 def secure_path(rel_path: str) -> str:
     """Return an absolute path inside MOVIES_DIR."""
-    abs_path = os.path.abspath(os.path.join(MOVIES_DIR, rel_path))
-    if not abs_path.startswith(os.path.abspath(MOVIES_DIR)):
+    abs_path = os.path.normpath(os.path.join(_MOVIES_ROOT, rel_path))
+    if not abs_path.startswith(_MOVIES_ROOT) and abs_path != _MOVIES_ROOT[:-1]:
         raise ValueError("Invalid path")
     return abs_path
 
+def _advise_willneed(path: str) -> bool:
+    """
+    Ask the kernel to read path ahead in the background without a user-space
+    read. Uses posix_fadvise on Linux and F_RDADVISE on macOS; returns False
+    if neither is available or the hint fails.
+    """
+    if not hasattr(os, 'posix_fadvise') and not (fcntl and sys.platform == 'darwin'):
+        return False
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError:
+        return False
+    try:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        else:
+            # struct radvisory { off_t ra_offset; int ra_count; }
+            fcntl.fcntl(fd, getattr(fcntl, 'F_RDADVISE', 44), struct.pack('qi4x', 0, 1 << 20))
+        return True
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+
 def ensure_local(path: str) -> None:
     """Attempt to access the file so that OneDrive downloads it if needed."""
+    if _advise_willneed(path):
+        return
     try:
         with open(path, 'rb') as f:
             f.read(1)
@@ -76,38 +165,82 @@ def get_lan_ip() -> str:
     finally:
         s.close()
 
-@app.route('/')
-def browse():
-    rel_path = request.args.get('path', '')
-    abs_path = secure_path(rel_path)
+def file_kind(name: str) -> str | None:
+    """Return 'video' or 'subtitle' for a supported file name, else None."""
+    m = _EXT_RE.search(name)
+    return _EXT_KIND[m.group(1).lower()] if m else None
 
-    # list folders first, then files; skip hidden files
-    names = [n for n in os.listdir(abs_path) if not n.startswith('.')]
-    dirs = [n for n in names if os.path.isdir(os.path.join(abs_path, n))]
-    files = [n for n in names if os.path.isfile(os.path.join(abs_path, n))]
-    dirs.sort(); files.sort()
-    entries = []
-    for name in dirs + files:
-        rel = os.path.join(rel_path, name) if rel_path else name
-        full = os.path.join(abs_path, name)
-        entry = {'name': name, 'is_dir': os.path.isdir(full), 'path': rel}
-        if not entry['is_dir']:
-            ext = os.path.splitext(name)[1].lower()
-            if ext in VIDEO_EXTS:
-                entry['type'] = 'video'
-            elif ext in SUB_EXTS:
-                entry['type'] = 'subtitle'
-            else:
-                continue
-        entries.append(entry)
 
-    # Show TV shortcut only at the root of MOVIES_DIR
-    tv_exists = (rel_path == '' and os.path.isdir(os.path.join(MOVIES_DIR, 'TV')))
-    selected_video = session.get('video')
-    selected_sub = session.get('subtitle')
-    delay = session.get('delay', 1.5)
+# Seconds a live directory listing is reused even if its mtime is unchanged
+# (OneDrive does not always bump a folder's mtime when its contents change)
+LIST_CACHE_TTL = max(1, int(os.getenv("LIST_CACHE_TTL", "30")))
+
 
-    template = '''
+@functools.lru_cache(maxsize=256)
+def _list_dir(abs_path: str, mtime_ns: int, ttl_bucket: int) -> tuple:
+    """
+    Return (name, is_dir, kind) rows for a directory, folders first.
+
+    Only folders and supported media files are kept; kind is None for
+    folders. mtime_ns and ttl_bucket are only part of the cache key: a
+    directory whose contents change gets a new mtime and is scanned again,
+    and every listing expires after at most LIST_CACHE_TTL seconds when the
+    bucket moves on; repeat visits in between are a cache hit. scandir reuses the type info from the directory
+    read, so we avoid a separate stat() per entry (expensive on
+    OneDrive-backed folders).
+    """
+    with os.scandir(abs_path) as it:
+        entries_raw = sorted(
+            (e for e in it if not e.name.startswith('.')),
+            key=lambda e: (not e.is_dir(follow_symlinks=False), e.name.lower()),
+        )
+    rows = []
+    for e in entries_raw:
+        if e.is_dir(follow_symlinks=False):
+            rows.append((e.name, True, None))
+            continue
+        kind = file_kind(e.name)
+        if kind and e.is_file():
+            rows.append((e.name, False, kind))
+    return tuple(rows)
+
+
+def _make_entry(name: str, is_dir: bool, kind: str | None, rel: str) -> dict:
+    """Return the template entry for a folder or media file."""
+    entry = {'name': name, 'is_dir': is_dir, 'path': rel}
+    if not is_dir:
+        entry['type'] = kind
+    return entry
+
+
+def list_entries(abs_path: str, rel_path: str) -> list:
+    """
+    Return the browse entries for abs_path.
+
+    Entries come from the SQLite library index once it is ready. Until then
+    (or without watchdog) the folder is listed live, reusing the cached
+    listing while the directory's mtime is unchanged for at most
+    LIST_CACHE_TTL seconds, so repeated navigation does not hit
+    OneDrive for metadata on every click.
+    """
+    if LIBRARY.ready.is_set():
+        entries = []
+        for rel, name, is_dir, ext in LIBRARY.list_dir(LIBRARY.rel(abs_path)):
+            kind = None if is_dir else _EXT_KIND.get(ext[1:])
+            if is_dir or kind:
+                entries.append(_make_entry(name, bool(is_dir), kind, rel))
+        return entries
+
+    return [
+        _make_entry(name, is_dir, kind, f"{rel_path}/{name}" if rel_path else name)
+        for name, is_dir, kind in _list_dir(
+            abs_path, os.stat(abs_path).st_mtime_ns, int(time.monotonic() // LIST_CACHE_TTL)
+        )
+    ]
+
+
+# Templates are compiled once at import instead of on every request
+BROWSE_TEMPLATE = app.jinja_env.from_string('''
 <!doctype html>
 <html lang="en">
 <head>
@@ -148,7 +281,7 @@ h1{margin:0;font-size:1.5rem;overflow:hidden;text-overflow:ellipsis;white-space:
   </div>
   {% endif %}
   {% for e in entries %}
-  <div class="tile {% if e.path==selected_video or e.path==selected_sub %}selected{% endif %}">
+  <div class="tile {% if e.path in selected %}selected{% endif %}">
     {% if e.is_dir %}
       <div class="icon">📁</div>
       <span>{{ e.name }}</span>
@@ -179,14 +312,66 @@ h1{margin:0;font-size:1.5rem;overflow:hidden;text-overflow:ellipsis;white-space:
   </div>
 </div>
 </body></html>
-'''
-    return render_template_string(
-        template,
+''')
+
+STREAMING_TEMPLATE = app.jinja_env.from_string('''
+    <h1>Streaming started</h1>
+    {% set stream_url = 'http://' ~ host ~ url_for('serve_hls', token=token, fname='master.m3u8') %}
+    <p>Stream URL: <a href="{{ stream_url }}">{{ stream_url }}</a></p>
+    <form action="{{ url_for('stop_stream') }}" method="post">
+        <button type="submit">Stop Streaming</button>
+    </form>
+    ''')
+
+def current_session(create: bool = False) -> dict:
+    """
+    Return the server-side session of this client.
+
+    Only requests that store something (select, start) pass create=True;
+    other requests from clients without a session get an empty, unsaved
+    dict, so cookieless visitors do not grow SESSIONS.
+    """
+    if 'session' not in g:
+        sid = request.cookies.get('sid')
+        if sid not in SESSIONS:
+            if not create:
+                return {}
+            sid = uuid.uuid4().hex
+            SESSIONS[sid] = {}
+        g.sid = sid
+        g.session = SESSIONS[sid]
+        g.session['last_seen'] = time.monotonic()
+    return g.session
+
+@app.after_request
+def save_session_cookie(response):
+    # Only new sessions need the cookie; existing clients already send it
+    sid = g.get('sid')
+    if sid and request.cookies.get('sid') != sid:
+        response.set_cookie('sid', sid, httponly=True, samesite='Lax')
+    return response
+
+@app.route('/')
+def browse():
+    rel_path = request.args.get('path', '')
+    abs_path = secure_path(rel_path)
+
+    entries = list_entries(abs_path, rel_path)
+
+    # Show TV shortcut only at the root of MOVIES_DIR
+    tv_exists = (rel_path == '' and is_dir_fast(os.path.join(MOVIES_DIR, 'TV')))
+    sess = current_session()
+    selected_video = sess.get('video')
+    selected_sub = sess.get('subtitle')
+    delay = sess.get('delay', 1.5)
+
+    return BROWSE_TEMPLATE.render(
         entries=entries,
         rel_path=rel_path,
         parent=os.path.dirname(rel_path),
         selected_video=selected_video,
         selected_sub=selected_sub,
+        selected={x for x in (selected_video, selected_sub) if x},
         delay=delay,
         tv_exists=tv_exists,
     )
@@ -197,72 +382,129 @@ def select_file():
     if not rel_path:
         return 'Invalid selection', 400
     abs_path = secure_path(rel_path)
-    if not os.path.isfile(abs_path):
+    if not is_file_fast(abs_path):
         return 'Not a file', 400
-    ext = os.path.splitext(rel_path)[1].lower()
-    if ext in VIDEO_EXTS:
-        session['video'] = rel_path
-    elif ext in SUB_EXTS:
-        session['subtitle'] = rel_path
+    kind = file_kind(rel_path)
+    sess = current_session(create=True)
+    if kind == 'video':
+        sess['video'] = rel_path
+    elif kind == 'subtitle':
+        sess['subtitle'] = rel_path
     else:
         return 'Unsupported file type', 400
     return redirect(url_for('browse', path=os.path.dirname(rel_path)))
 
+def _stop_session_stream(sess: dict) -> None:
+    """Stop the ffmpeg job of a session's stream, then delete its folder."""
+    STREAMS.pop(sess.pop('stream_token', None), None)
+    stream_folder = sess.pop('stream_folder', None)
+    job = sess.pop('stream_job', None)
+    if not stream_folder:
+        return
+    # A finished job needs nothing, a queued one is cancelled before it
+    # starts, and a running one is terminated
+    if job is None or not (job.done() or job.cancel()):
+        stop_ffmpeg(stream_folder)
+    shutil.rmtree(stream_folder, ignore_errors=True)
+
+def expire_idle_sessions() -> None:
+    """Drop sessions idle for SESSION_IDLE_TIMEOUT, stopping their streams."""
+    cutoff = time.monotonic() - SESSION_IDLE_TIMEOUT
+    for sid, sess in list(SESSIONS.items()):
+        if sess.get('last_seen', cutoff) < cutoff:
+            SESSIONS.pop(sid, None)
+            _stop_session_stream(sess)
+
+def _expire_sessions_forever() -> None:
+    # Abandoned sessions would otherwise keep their output (possibly a whole
+    # movie in /dev/shm) until the process exits
+    while True:
+        time.sleep(min(60, SESSION_IDLE_TIMEOUT))
+        expire_idle_sessions()
+
+if SESSION_IDLE_TIMEOUT > 0:
+    threading.Thread(target=_expire_sessions_forever, daemon=True).start()
+
 @app.route('/start', methods=['POST'])
 def start_stream():
     delay = float(request.form.get('delay', 1.5))
-    session['delay'] = delay
-    video_rel = session.get('video')
+    sess = current_session(create=True)
+    sess['delay'] = delay
+    video_rel = sess.get('video')
     if not video_rel:
         return 'No video selected', 400
-    subtitle_rel = session.get('subtitle')
+    subtitle_rel = sess.get('subtitle')
 
     movie_path = secure_path(video_rel)
     subtitle_path = secure_path(subtitle_rel) if subtitle_rel else None
 
     validate_paths(movie_path, subtitle_path)
-    ensure_local(movie_path)
+    # Hydrate in the background; ffmpeg blocks on its own reads if needed
+    PREFETCH_POOL.submit(ensure_local, movie_path)
     if subtitle_path:
-        ensure_local(subtitle_path)
+        PREFETCH_POOL.submit(ensure_local, subtitle_path)
 
-    movie_folder = os.path.dirname(movie_path)
-    stream_folder = os.path.join(movie_folder, 'stream')
+    stream_folder = make_stream_folder(movie_path)
 
     def worker():
-        run_ffmpeg(movie_path, subtitle_path, stream_folder, 9000, delay)
+        run_ffmpeg(movie_path, subtitle_path, stream_folder, delay,
+                   encode=needs_transcode(movie_path))
 
-    threading.Thread(target=worker, daemon=True).start()
+    # Replace this client's previous stream; other clients keep theirs
+    _stop_session_stream(sess)
+    sess['stream_folder'] = stream_folder
+    sess['stream_job'] = FFMPEG_POOL.submit(worker)
+    token = uuid.uuid4().hex
+    sess['stream_token'] = token
+    STREAMS[token] = sess
     if is_vpn_active():
-        host = get_lan_ip()
+        # Keep the port the interface was reached on; a ':' inside an IPv6
+        # literal such as [::1] is not a port separator
+        _, sep, port = request.host.rpartition(':')
+        if not sep or ']' in port:
+            port = ''
+        host = f"{get_lan_ip()}:{port}" if port else get_lan_ip()
     else:
-        host = request.host.split(':')[0]
+        host = request.host
     # Render a page showing the stream URL and a stop button
-    template = '''
-    <h1>Streaming started</h1>
-    <p>Stream URL: <a href="http://{{ host }}:9000/master.m3u8">http://{{ host }}:9000/master.m3u8</a></p>
-    <form action="{{ url_for('stop_stream') }}" method="post">
-        <button type="submit">Stop Streaming</button>
-    </form>
-    '''
-    return render_template_string(template, host=host)
+    return STREAMING_TEMPLATE.render(host=host, token=token)
+
+@app.route('/hls/<token>/<path:fname>')
+def serve_hls(token, fname):
+    # Serve playlists and segments of a session's stream from the Flask app.
+    # The stream token is in the URL because players do not send the cookie.
+    sess = STREAMS.get(token, {})
+    stream_folder = sess.get('stream_folder')
+    if not stream_folder:
+        return 'No active stream', 404
+    # Players do not send the cookie, so keep a watched stream alive here
+    sess['last_seen'] = time.monotonic()
+    # send_from_directory wraps the file with the WSGI server's file wrapper
+    # (sendfile under Gunicorn) and handles Range/ETag/304 requests
+    mimetype = HLS_MIMETYPES.get(os.path.splitext(fname)[1].lower())
+    return send_from_directory(stream_folder, fname, conditional=True, mimetype=mimetype)
 
 @app.route('/stop_stream', methods=['POST'])
 def stop_stream():
     # Stop streaming: cleanup the stream folder and reset session
-    video_rel = session.pop('video', None)
-    session.pop('subtitle', None)
-    session.pop('delay', None)
-    if video_rel:
-        try:
-            movie_path = secure_path(video_rel)
-            stream_folder = os.path.join(os.path.dirname(movie_path), 'stream')
-            shutil.rmtree(stream_folder, ignore_errors=True)
-        except Exception:
-            pass
+    secure_path.cache_clear()
+    sess = current_session()
+    _stop_session_stream(sess)
+    video_rel = sess.pop('video', None)
+    sess.pop('subtitle', None)
+    sess.pop('delay', None)
     # Redirect back to browsing interface
     parent = os.path.dirname(video_rel) if video_rel else ''
     return redirect(url_for('browse', path=parent))
 
 if __name__ == '__main__':
-    # Run the Flask app on all network interfaces at port 6001
-    app.run(debug=True, host='0.0.0.0', port=6001)
+    # The Werkzeug server handles one request at a time; use wsgi.py for real use
+    warnings.warn(
+        "Running the development server; use "
+        "`gunicorn -k gthread -w 1 --threads 8 --bind 0.0.0.0:6001 wsgi:app` in production",
+        RuntimeWarning,
+    )
+    # Run the Flask app on all network interfaces at port 6001. Debug mode is
+    # opt-in via FLASK_DEBUG=1 and the reloader (which polls every source
+    # file) stays off either way.
+    app.run(debug=os.getenv("FLASK_DEBUG") == "1", use_reloader=False, host='0.0.0.0', port=6001)
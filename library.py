@@ -0,0 +1,208 @@
+"""
+Persistent SQLite index of the movies folder.
+
+Listing a OneDrive-backed folder can take seconds because metadata is fetched
+lazily, so the tree is walked once in the background and then kept up to date
+by a watchdog observer. The browser view reads a folder with a single indexed
+query instead of listing it live.
+"""
+
+import os
+import sqlite3
+import threading
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # Optional; without it the index cannot stay in sync
+    FileSystemEventHandler = object
+    Observer = None
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    rel_path TEXT PRIMARY KEY,
+    parent   TEXT NOT NULL,
+    name     TEXT NOT NULL,
+    is_dir   INTEGER NOT NULL,
+    ext      TEXT NOT NULL,
+    mtime    REAL NOT NULL,
+    size     INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent, is_dir, name);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+'''
+
+
+class _IndexEventHandler(FileSystemEventHandler):
+    """Forward filesystem events from watchdog to a LibraryIndex."""
+
+    def __init__(self, index: "LibraryIndex") -> None:
+        super().__init__()
+        self.index = index
+
+    def on_created(self, event) -> None:
+        self.index.upsert(event.src_path)
+
+    def on_modified(self, event) -> None:
+        if not event.is_directory:
+            self.index.upsert(event.src_path)
+
+    def on_deleted(self, event) -> None:
+        self.index.remove(event.src_path)
+
+    def on_moved(self, event) -> None:
+        self.index.remove(event.src_path)
+        self.index.upsert(event.dest_path)
+
+
+class LibraryIndex:
+    """
+    SQLite table of every visible folder and file below root.
+
+    Paths are stored relative to root with '/' separators, matching the
+    paths used by the browser view. Hidden entries (names starting with a
+    dot) and everything below them are skipped.
+    """
+
+    def __init__(self, root: str, db_path: str) -> None:
+        self.root = os.path.abspath(root)
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        # Set once the index can answer queries; a previous run's index of
+        # the same root is used right away while the startup rescan
+        # reconciles it.
+        self.ready = threading.Event()
+        self.observer = None
+        # Watchdog events seen while rebuild() walks the tree; None otherwise
+        self._pending = None
+        stored = self.conn.execute("SELECT value FROM meta WHERE key = 'root'").fetchone()
+        if stored is None or stored[0] != self.root:
+            # Index of another folder (or none yet): start from scratch
+            with self.conn:
+                self.conn.execute("DELETE FROM entries")
+                self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('root', ?)", (self.root,))
+        elif self.conn.execute("SELECT 1 FROM entries LIMIT 1").fetchone():
+            self.ready.set()
+
+    def rel(self, abs_path: str) -> str:
+        """Return abs_path relative to root using '/' separators ('' for root)."""
+        rel = os.path.relpath(abs_path, self.root)
+        if rel == os.curdir:
+            return ''
+        return rel.replace(os.sep, '/')
+
+    def _row(self, rel_path: str, st: os.stat_result, is_dir: bool) -> tuple:
+        parent, _, name = rel_path.rpartition('/')
+        ext = '' if is_dir else os.path.splitext(name)[1].lower()
+        return (rel_path, parent, name, int(is_dir), ext, st.st_mtime, st.st_size)
+
+    def _scan(self, abs_path: str) -> list:
+        """Walk abs_path with scandir and return index rows for everything below it."""
+        rows = []
+        stack = [abs_path]
+        while stack:
+            folder = stack.pop()
+            rel_folder = self.rel(folder)
+            try:
+                with os.scandir(folder) as it:
+                    for e in it:
+                        if e.name.startswith('.'):
+                            continue
+                        is_dir = e.is_dir(follow_symlinks=False)
+                        if not is_dir and not e.is_file():
+                            continue
+                        rel = f"{rel_folder}/{e.name}" if rel_folder else e.name
+                        rows.append(self._row(rel, e.stat(follow_symlinks=False), is_dir))
+                        if is_dir:
+                            stack.append(e.path)
+            except OSError as exc:
+                print(f"Warning: could not index {folder}: {exc}")
+        return rows
+
+    def rebuild(self) -> None:
+        """
+        Replace the whole index with a fresh walk of root.
+
+        Changes reported by watchdog during the walk are recorded and applied
+        again after the swap, so the older snapshot does not undo them.
+        """
+        with self.lock:
+            self._pending = []
+        rows = self._scan(self.root)
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM entries")
+            self.conn.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            pending, self._pending = self._pending, None
+        for apply, abs_path in pending:
+            apply(abs_path)
+        self.ready.set()
+
+    def _is_hidden(self, rel_path: str) -> bool:
+        return any(part.startswith('.') for part in rel_path.split('/'))
+
+    def upsert(self, abs_path: str) -> None:
+        """Add or refresh abs_path (and, for folders, everything below it)."""
+        rel_path = self.rel(abs_path)
+        if not rel_path or rel_path.startswith('..') or self._is_hidden(rel_path):
+            return
+        try:
+            st = os.stat(abs_path, follow_symlinks=False)
+        except OSError:
+            self.remove(abs_path)
+            return
+        is_dir = os.path.isdir(abs_path) and not os.path.islink(abs_path)
+        if not is_dir and not os.path.isfile(abs_path):
+            return
+        rows = [self._row(rel_path, st, is_dir)]
+        if is_dir:
+            rows.extend(self._scan(abs_path))
+        with self.lock, self.conn:
+            if self._pending is not None:
+                self._pending.append((self.upsert, abs_path))
+            self.conn.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def remove(self, abs_path: str) -> None:
+        """Drop abs_path and everything below it from the index."""
+        rel_path = self.rel(abs_path)
+        if not rel_path or rel_path.startswith('..'):
+            return
+        # Range check on the '/'-terminated prefix: case-sensitive, unlike
+        # LIKE, so a sibling differing only in case is kept ('0' follows '/')
+        with self.lock, self.conn:
+            if self._pending is not None:
+                self._pending.append((self.remove, abs_path))
+            self.conn.execute(
+                "DELETE FROM entries WHERE rel_path = ? OR (rel_path >= ? AND rel_path < ?)",
+                (rel_path, rel_path + '/', rel_path + '0'),
+            )
+
+    def list_dir(self, rel_path: str) -> list:
+        """Return (rel_path, name, is_dir, ext) rows of a folder, folders first."""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT rel_path, name, is_dir, ext FROM entries WHERE parent = ? "
+                "ORDER BY is_dir DESC, name COLLATE NOCASE",
+                (rel_path,),
+            ).fetchall()
+
+    def start(self) -> bool:
+        """
+        Watch root for changes and rescan it in the background.
+
+        Returns False (and leaves the index unused) if watchdog is not
+        installed or root does not exist, since the index could go stale.
+        """
+        if Observer is None or not os.path.isdir(self.root):
+            self.ready.clear()
+            return False
+        self.observer = Observer()
+        self.observer.schedule(_IndexEventHandler(self), self.root, recursive=True)
+        self.observer.daemon = True
+        self.observer.start()
+        threading.Thread(target=self.rebuild, daemon=True).start()
+        return True
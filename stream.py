@@ -12,12 +12,18 @@ Example:
 
 import argparse
 import atexit
+import collections
+import ctypes
+import errno
+import functools
 import http.server
 import os
 import shutil
-import socketserver
+import stat
 import subprocess
 import sys
+import tempfile
+import threading
 from dotenv import load_dotenv
 from typing import NoReturn
 
@@ -45,6 +51,73 @@ def cleanup_stream_folder():
 # Register the cleanup function to run at program exit
 atexit.register(cleanup_stream_folder)
 
+# statx(2) constants (see linux/fcntl.h and linux/stat.h)
+AT_FDCWD = -100
+AT_STATX_DONT_SYNC = 0x4000
+STATX_TYPE = 0x0001
+
+class _Statx(ctypes.Structure):
+    """Leading fields of struct statx; the kernel expects a 256-byte buffer."""
+    _fields_ = [
+        ("stx_mask", ctypes.c_uint32),
+        ("stx_blksize", ctypes.c_uint32),
+        ("stx_attributes", ctypes.c_uint64),
+        ("stx_nlink", ctypes.c_uint32),
+        ("stx_uid", ctypes.c_uint32),
+        ("stx_gid", ctypes.c_uint32),
+        ("stx_mode", ctypes.c_uint16),
+        ("_rest", ctypes.c_ubyte * 226),
+    ]
+
+@functools.lru_cache(maxsize=None)
+def _libc_statx():
+    """
+    Return libc's statx function, or None if it is not available.
+
+    The lookup is done once; on non-Linux platforms or older glibc versions
+    callers fall back to os.stat.
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        fn = ctypes.CDLL("libc.so.6", use_errno=True).statx
+    except (OSError, AttributeError):
+        return None
+    fn.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_uint, ctypes.POINTER(_Statx)]
+    fn.restype = ctypes.c_int
+    return fn
+
+def statx_type(path: str) -> int | None:
+    """
+    Return the file type bits (S_IFMT) of path, or None if it does not exist.
+
+    On Linux this uses statx(AT_STATX_DONT_SYNC, STATX_TYPE), which asks only
+    for the type and lets network filesystems answer from cached metadata.
+    Elsewhere, or if statx fails for any reason other than a missing path, it
+    falls back to os.stat.
+    """
+    fn = _libc_statx()
+    if fn is not None:
+        buf = _Statx()
+        if fn(AT_FDCWD, os.fsencode(path), AT_STATX_DONT_SYNC, STATX_TYPE, ctypes.byref(buf)) == 0:
+            return stat.S_IFMT(buf.stx_mode)
+        # A missing path is final; any other failure (ENOSYS, EPERM from a
+        # seccomp filter, EINVAL for an unsupported flag...) retries with stat
+        if ctypes.get_errno() in (errno.ENOENT, errno.ENOTDIR):
+            return None
+    try:
+        return stat.S_IFMT(os.stat(path).st_mode)
+    except (OSError, ValueError):
+        return None
+
+def is_dir_fast(path: str) -> bool:
+    """Return True if path is a directory, without forcing a filesystem sync."""
+    return statx_type(path) == stat.S_IFDIR
+
+def is_file_fast(path: str) -> bool:
+    """Return True if path is a regular file, without forcing a filesystem sync."""
+    return statx_type(path) == stat.S_IFREG
+
 def parse_arguments() -> argparse.Namespace:
     """
     Parse command-line arguments using argparse.
@@ -81,6 +154,76 @@ def parse_arguments() -> argparse.Namespace:
     )
     return parser.parse_args()
 
+# Prefix of HLS output folders and the file recording the owning process
+STREAM_FOLDER_PREFIX = "stream_"
+STREAM_OWNER_FILE = ".owner"
+
+def make_stream_folder(movie_path: str) -> str:
+    """
+    Create a fresh folder for HLS output outside the movies folder.
+
+    Segments are written to STREAM_DIR if set. Otherwise the /dev/shm tmpfs
+    is used when it has room for a copy of the movie (the event playlist
+    keeps every segment), falling back to the system temp dir. Either way
+    they never touch a OneDrive-synced folder or trigger an upload.
+
+    Args:
+        movie_path: The movie that will be converted into the folder.
+
+    Returns:
+        The absolute path of the new folder.
+    """
+    parent = os.getenv("STREAM_DIR")
+    if not parent:
+        parent = tempfile.gettempdir()
+        if os.path.isdir("/dev/shm"):
+            try:
+                # Leave some headroom for playlists and container overhead
+                if shutil.disk_usage("/dev/shm").free > os.path.getsize(movie_path) * 1.1:
+                    parent = "/dev/shm"
+            except OSError:
+                pass
+    folder = tempfile.mkdtemp(prefix=STREAM_FOLDER_PREFIX, dir=parent)
+    with open(os.path.join(folder, STREAM_OWNER_FILE), "w") as owner:
+        owner.write(str(os.getpid()))
+    return folder
+
+def _pid_alive(pid: int) -> bool:
+    """Return True if a process with this pid exists (always True on Windows)."""
+    if os.name == "nt":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def cleanup_stale_stream_folders() -> None:
+    """
+    Delete stream folders left behind by processes that no longer exist,
+    e.g. a killed worker, so their segments do not pin tmpfs memory.
+    """
+    parents = {os.getenv("STREAM_DIR") or "/dev/shm", tempfile.gettempdir()}
+    for parent in parents:
+        try:
+            names = os.listdir(parent)
+        except OSError:
+            continue
+        for name in names:
+            if not name.startswith(STREAM_FOLDER_PREFIX):
+                continue
+            folder = os.path.join(parent, name)
+            try:
+                with open(os.path.join(folder, STREAM_OWNER_FILE)) as owner:
+                    pid = int(owner.read().strip())
+            except (OSError, ValueError):
+                continue  # Not one of ours
+            if pid != os.getpid() and not _pid_alive(pid):
+                print(f"Removing stale stream folder {folder}")
+                shutil.rmtree(folder, ignore_errors=True)
+
 def validate_paths(movie_path: str, subtitle_path: str | None = None) -> None:
     """
     Validate that the required video file and optional subtitle file exist.
@@ -92,14 +235,39 @@ def validate_paths(movie_path: str, subtitle_path: str | None = None) -> None:
     Raises:
         SystemExit: If any of the required paths are invalid.
     """
-    if not os.path.isfile(movie_path):
+    if not is_file_fast(movie_path):
         print(f"Error: Movie file '{movie_path}' not found.")
         sys.exit(1)
 
-    if subtitle_path and not os.path.isfile(subtitle_path):
+    if subtitle_path and not is_file_fast(subtitle_path):
         print(f"Error: Subtitle file '{subtitle_path}' not found.")
         sys.exit(1)
 
+class SendfileHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Static file handler that writes file bodies with os.sendfile, so segment
+    data is copied by the kernel instead of through Python buffers.
+    """
+
+    def copyfile(self, source, outputfile) -> None:
+        try:
+            in_fd = source.fileno()
+            out_fd = outputfile.fileno()
+        except (AttributeError, OSError):
+            super().copyfile(source, outputfile)
+            return
+        if not hasattr(os, "sendfile"):
+            super().copyfile(source, outputfile)
+            return
+        outputfile.flush()
+        offset = source.tell()
+        size = os.fstat(in_fd).st_size
+        while offset < size:
+            sent = os.sendfile(out_fd, in_fd, offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+
 def serve_output(stream_folder_path: str, port: int = 9000) -> NoReturn:
     """
     Launch a Python HTTP server to serve HLS files from the specified directory.
@@ -111,14 +279,13 @@ def serve_output(stream_folder_path: str, port: int = 9000) -> NoReturn:
     Raises:
         KeyboardInterrupt: If the user stops the server manually.
     """
-    os.chdir(stream_folder_path)
-    handler = http.server.SimpleHTTPRequestHandler
+    handler = functools.partial(SendfileHTTPRequestHandler, directory=stream_folder_path)
 
-    print(f"\nConversion complete! Serving HLS stream on http://localhost:{port}/output.m3u8")
+    print(f"\nServing HLS stream on http://localhost:{port}/output.m3u8")
     print(f"You can also access the HLS master playlist at http://localhost:{port}/master.m3u8")
     print("Press Ctrl+C to stop the server.")
 
-    with socketserver.TCPServer(("", port), handler) as httpd:
+    with http.server.ThreadingHTTPServer(("", port), handler) as httpd:
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
@@ -126,23 +293,123 @@ def serve_output(stream_folder_path: str, port: int = 9000) -> NoReturn:
             httpd.server_close()
             sys.exit(0)
 
+# Video codecs that can be copied straight into HLS segments
+HLS_VIDEO_CODECS = {"h264", "hevc"}
+
+# Hardware encoders by FFMPEG_HWACCEL name: (decode options, encode options)
+HW_ENCODERS = {
+    "videotoolbox": (["-hwaccel", "videotoolbox"], ["-c:v", "h264_videotoolbox", "-b:v", "5M"]),
+    "cuda": (["-hwaccel", "cuda"], ["-c:v", "h264_nvenc", "-preset", "p4", "-b:v", "5M"]),
+    "qsv": (["-hwaccel", "qsv"], ["-c:v", "h264_qsv", "-b:v", "5M"]),
+}
+SOFTWARE_ENCODER = ["-c:v", "libx264", "-preset", "veryfast", "-crf", "23"]
+
+def needs_transcode(movie_path: str) -> bool:
+    """
+    Use ffprobe to check whether the movie's video stream must be re-encoded
+    before it can be segmented into HLS.
+
+    Returns False if ffprobe is unavailable, so the video is copied as before.
+    """
+    try:
+        result = subprocess.run(
+            ["ffprobe", "-v", "error", "-select_streams", "v:0",
+             "-show_entries", "stream=codec_name", "-of", "default=nw=1:nk=1", movie_path],
+            capture_output=True, text=True, check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    codec = result.stdout.strip()
+    return bool(codec) and codec not in HLS_VIDEO_CODECS
+
+@functools.lru_cache(maxsize=None)
+def pick_hwaccel() -> str | None:
+    """
+    Return the HW_ENCODERS key to use for transcoding, or None for software.
+
+    The FFMPEG_HWACCEL environment variable takes precedence ("none" forces
+    software encoding). Otherwise each hardware encoder compiled into ffmpeg
+    is tried once with a one-frame test encode, since builds list encoders
+    such as h264_nvenc even on machines without the matching GPU.
+    """
+    forced = os.getenv("FFMPEG_HWACCEL", "").strip().lower()
+    if forced:
+        return forced if forced in HW_ENCODERS else None
+    try:
+        encoders = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"],
+            capture_output=True, text=True, check=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    candidates = ["videotoolbox", "cuda", "qsv"] if sys.platform == "darwin" else ["cuda", "qsv"]
+    for name in candidates:
+        encoder = HW_ENCODERS[name][1][1]
+        if encoder in encoders and _encoder_works(encoder):
+            return name
+    return None
+
+def _encoder_works(encoder: str) -> bool:
+    """Return True if ffmpeg can encode a single test frame with encoder."""
+    try:
+        subprocess.run(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error",
+             "-f", "lavfi", "-i", "nullsrc=s=256x256", "-frames:v", "1",
+             "-c:v", encoder, "-f", "null", "-"],
+            capture_output=True, check=True, timeout=30,
+        )
+    except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired):
+        return False
+    return True
+
+def pick_video_encoder() -> list[str]:
+    """Return the FFmpeg video codec options to use when transcoding."""
+    hwaccel = pick_hwaccel()
+    return HW_ENCODERS[hwaccel][1] if hwaccel else SOFTWARE_ENCODER
+
+# Master playlists; the content only depends on whether subtitles are present
+_MASTER_WITH_SUBS = (
+    "#EXTM3U\n\n"
+    '#EXT-X-MEDIA:TYPE=SUBTITLES,GROUP-ID="subs",NAME="English",DEFAULT=NO,AUTOSELECT=YES,LANGUAGE="en",URI="output_vtt.m3u8"\n\n'
+    '#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=1920x1080,SUBTITLES="subs"\n'
+    "output.m3u8\n"
+)
+_MASTER_NO_SUBS = (
+    "#EXTM3U\n\n"
+    "#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=1920x1080\n"
+    "output.m3u8\n"
+)
+
+# Running FFmpeg processes by output folder, and folders whose job was stopped
+_FFMPEG_PROCS: dict[str, subprocess.Popen] = {}
+_FFMPEG_STOPPED: set[str] = set()
+_FFMPEG_LOCK = threading.Lock()
+
 def run_ffmpeg(
     movie_path: str,
     subtitle_path: str | None,
     stream_folder_path: str,
-    port: int = 8000,
-    subtitle_delay: float = 0.0
+    subtitle_delay: float = 0.0,
+    encode: bool = False
 ) -> None:
     """
     Execute an FFmpeg command to convert a movie and optional subtitle file
     into an HLS playlist with optional WebVTT subtitles.
 
+    The master playlist is written before FFmpeg starts, so the output can be
+    served while segments are still being produced.
+
     Args:
         movie_path: Path to the movie file.
         subtitle_path: Optional path to the subtitle file.
-        stream_folder_path: Path where output HLS segments and playlists will be stored.
-        port: Port number to serve the HLS stream on.
+        stream_folder_path: Existing folder (see make_stream_folder()) where output
+            HLS segments and playlists will be stored.
         subtitle_delay: Number of seconds to delay subtitles (can be negative).
+        encode: Re-encode the video (using a hardware encoder when available)
+            instead of copying it.
+
+    The process is registered under stream_folder_path so stop_ffmpeg() can
+    terminate it; a stopped job returns quietly.
 
     Raises:
         SystemExit: If FFmpeg fails.
@@ -151,12 +418,14 @@ def run_ffmpeg(
     global STREAM_FOLDER_PATH
     STREAM_FOLDER_PATH = stream_folder_path
 
-    # Create stream folder if it doesn't exist
-    os.makedirs(stream_folder_path, exist_ok=True)
-
     # Start with ffmpeg command and input files
     ffmpeg_command = ["ffmpeg"]
 
+    # Hardware decoding must be requested before the first input
+    hwaccel = pick_hwaccel() if encode else None
+    if hwaccel:
+        ffmpeg_command.extend(HW_ENCODERS[hwaccel][0])
+
     # Add all input files first
     ffmpeg_command.extend(["-i", movie_path])
     if subtitle_path:
@@ -176,8 +445,11 @@ def run_ffmpeg(
         ])
 
     # Add codec options
+    if encode:
+        ffmpeg_command.extend(pick_video_encoder())
+    else:
+        ffmpeg_command.extend(["-c:v", "copy"])  # Copy video codec
     ffmpeg_command.extend([
-        "-c:v", "copy",    # Copy video codec
         "-c:a", "copy",    # Copy audio codec
     ])
 
@@ -188,34 +460,89 @@ def run_ffmpeg(
 
     # Add output options
     ffmpeg_command.extend([
+        "-threads", "0",   # Let each ffmpeg process use all cores
         "-start_number", "0",
-        "-hls_time", "10",
-        "-hls_list_size", "0",
-        "-hls_segment_filename", os.path.join(stream_folder_path, "segment_%03d.ts"),
+        "-hls_segment_type", "fmp4",    # Fragmented MP4 segments
+        "-hls_flags", "temp_file+independent_segments",  # Publish segments atomically
+        "-hls_playlist_type", "event",  # Playlist only grows; no rewrites of old entries
+        "-hls_init_time", "4",
+        "-hls_time", "6",
+        "-hls_segment_filename", os.path.join(stream_folder_path, "segment_%03d.m4s"),
         os.path.join(stream_folder_path, "output.m3u8")
     ])
 
     print("Running FFmpeg command:")
     print(" ".join(ffmpeg_command))
 
-    try:
-        subprocess.run(ffmpeg_command, check=True)
+    with _FFMPEG_LOCK:
+        # stop_ffmpeg() may have been called (and the folder removed) before
+        # the job got this far; check before writing anything into it
+        if stream_folder_path in _FFMPEG_STOPPED:
+            _FFMPEG_STOPPED.discard(stream_folder_path)
+            return
+
+        # Write the master playlist up front so clients can start playing
+        # while ffmpeg is still producing segments
         master_playlist_path = os.path.join(stream_folder_path, "master.m3u8")
         with open(master_playlist_path, "w") as master_playlist:
-            master_playlist.write("#EXTM3U\n\n")
             # Add subtitle track to master playlist only if subtitles were provided
-            if subtitle_path:
-                master_playlist.write('#EXT-X-MEDIA:TYPE=SUBTITLES,GROUP-ID="subs",NAME="English",DEFAULT=NO,AUTOSELECT=YES,LANGUAGE="en",URI="output_vtt.m3u8"\n\n')
-                master_playlist.write('#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=1920x1080,SUBTITLES="subs"\n')
-            else:
-                master_playlist.write('#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=1920x1080\n')
-            master_playlist.write("output.m3u8\n")
-    except subprocess.CalledProcessError as exc:
-        print(f"FFmpeg failed with error code {exc.returncode}.")
-        sys.exit(exc.returncode)
-
-    # Serve the output
-    serve_output(stream_folder_path, port)
+            master_playlist.write(_MASTER_WITH_SUBS if subtitle_path else _MASTER_NO_SUBS)
+
+        proc = subprocess.Popen(
+            ffmpeg_command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        _FFMPEG_PROCS[stream_folder_path] = proc
+    try:
+        # ffmpeg reports progress on stderr, ending each stats line with "\r"
+        last_lines = collections.deque(maxlen=20)
+        for line in proc.stderr:
+            line = line.rstrip()
+            if not line:
+                continue
+            last_lines.append(line)
+            if line.startswith(("frame=", "size=")):
+                print(f"FFmpeg progress: {line}")
+        proc.wait()
+    finally:
+        with _FFMPEG_LOCK:
+            _FFMPEG_PROCS.pop(stream_folder_path, None)
+            stopped = stream_folder_path in _FFMPEG_STOPPED
+            _FFMPEG_STOPPED.discard(stream_folder_path)
+
+    if stopped:
+        print(f"FFmpeg stopped for {stream_folder_path}.")
+        return
+    if proc.returncode != 0:
+        print("\n".join(last_lines))
+        print(f"FFmpeg failed with error code {proc.returncode}.")
+        sys.exit(proc.returncode)
+
+def stop_ffmpeg(stream_folder_path: str, timeout: float = 10.0) -> None:
+    """
+    Terminate the FFmpeg job writing into stream_folder_path and wait for it.
+
+    If the job has not started FFmpeg yet, it is marked so that run_ffmpeg()
+    returns without starting it.
+
+    Args:
+        stream_folder_path: Output folder passed to run_ffmpeg().
+        timeout: Seconds to wait after SIGTERM before killing FFmpeg.
+    """
+    with _FFMPEG_LOCK:
+        _FFMPEG_STOPPED.add(stream_folder_path)
+        proc = _FFMPEG_PROCS.get(stream_folder_path)
+    if proc is None:
+        return
+    proc.terminate()
+    try:
+        proc.wait(timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
 
 def main() -> None:
     """
@@ -223,7 +550,7 @@ def main() -> None:
     1. Argument parsing (paths relative to Movies/).
     2. Path validation.
     3. FFmpeg HLS generation.
-    4. Serving the output via an HTTP server.
+    4. Serving the output via an HTTP server while it is generated.
     """
     args = parse_arguments()
 
@@ -238,16 +565,30 @@ def main() -> None:
     # Validate input files
     validate_paths(movie_path, subtitle_path)
 
-    # Figure out where the output should go (same folder as the movie)
-    movie_folder_path = os.path.dirname(movie_path)
-    stream_folder_path = os.path.join(movie_folder_path, "stream")
+    # Write the output to a scratch folder outside the movies folder
+    cleanup_stale_stream_folders()
+    stream_folder_path = make_stream_folder(movie_path)
 
     # Set global stream folder path for cleanup
     global STREAM_FOLDER_PATH
     STREAM_FOLDER_PATH = stream_folder_path
 
+    # Serve the output while it is being generated
+    server = threading.Thread(target=serve_output, args=(stream_folder_path, args.port), daemon=True)
+    server.start()
+
     # Convert to HLS
-    run_ffmpeg(movie_path, subtitle_path, stream_folder_path, args.port, args.subtitle_delay)
+    run_ffmpeg(
+        movie_path, subtitle_path, stream_folder_path, args.subtitle_delay,
+        encode=needs_transcode(movie_path),
+    )
+
+    print("\nConversion complete! Press Ctrl+C to stop the server.")
+    try:
+        server.join()
+    except KeyboardInterrupt:
+        print("\nStopping server...")
+        sys.exit(0)
 
 if __name__ == "__main__":
     main()
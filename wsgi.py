@@ -0,0 +1,14 @@
+"""
+WSGI entry point for running the web interface under Gunicorn:
+
+    gunicorn -k gthread -w 1 --threads 8 --bind 0.0.0.0:6001 wsgi:app
+
+A single worker is used because sessions, streams and the library index live
+in process memory. Its threads provide the concurrency. Directory scans,
+stat calls and SQLite block the calling thread, so real threads are used
+rather than gevent greenlets, which would stall every client.
+"""
+
+from app import app
+
+__all__ = ["app"]